@@ -20,11 +20,14 @@ class DecoderTransformerConfig:
     mha_type: str
     rope: bool
     num_layers: int
+    dtype: str
+    fp8: bool
 
 
 @dataclass
 class TrainerConfig:
     learning_rate: float
+    optimizer_8bit: bool
     batch_size: int
     n_training_iter: int
     n_eval_iter: int
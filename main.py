@@ -39,6 +39,8 @@ def main(dict_config: DictConfig):
         config.model.rope,
         config.model.num_layers,
         dataset.vocab_size,
+        config.model.dtype,
+        config.model.fp8,
         sk,
     )
 
@@ -53,6 +55,7 @@ def main(dict_config: DictConfig):
             train_dataset,
             test_dataset,
             config.trainer.learning_rate,
+            config.trainer.optimizer_8bit,
             config.trainer.batch_size,
             config.trainer.n_training_iter,
             config.trainer.n_eval_iter,
@@ -3,9 +3,10 @@ from pathlib import Path
 from typing import Optional
 
 import equinox as eqx
-import jax.numpy as jnp
-from beartype import beartype
-from jaxtyping import Array, Int, jaxtyped
+import numpy as np
+from jaxtyping import Int
+
+from ..typecheck import typecheck
 
 
 class ShakespearDataset(eqx.Module):
@@ -14,9 +15,12 @@ class ShakespearDataset(eqx.Module):
     This dataset will encode the text into integers and provide sequences of
     tokens of a given length. You can use it to extract random sequences of tokens.
     It does not use a complicated tokenization scheme, but a raw character-based encoding.
+
+    The encoded text is kept on the host so that a whole batch of sequences
+    can be gathered at once before being sent to the device.
     """
     text: str
-    encoded_text: Int[Array, " total_characters"]
+    encoded_text: Int[np.ndarray, " total_characters"]
     uniq_chars: list[str]
     char_to_int: dict[str, int]
     int_to_char: dict[int, str]
@@ -37,12 +41,15 @@ class ShakespearDataset(eqx.Module):
         self.int_to_char = {id: char for id, char in self.char_to_int.items()}
 
         encoded_text = [self.char_to_int[char] for char in text]
-        self.encoded_text = jnp.array(encoded_text)
-
-    @jaxtyped(typechecker=beartype)
-    def __getitem__(self, i: Int[Array, ""]) -> Int[Array, " seq_len"]:
-        """Return the ith sequence of tokens."""
-        tokens = self.encoded_text[i : i + self.seq_len]
+        self.encoded_text = np.array(encoded_text, dtype=np.int32)
+
+    @typecheck
+    def __getitem__(
+        self, ids: Int[np.ndarray, "*batch_size"]
+    ) -> Int[np.ndarray, "*batch_size seq_len"]:
+        """Return the sequences of tokens starting at the given ids."""
+        positions = ids[..., None] + np.arange(self.seq_len)
+        tokens = self.encoded_text[positions]
         return tokens
 
     def __len__(self) -> int:
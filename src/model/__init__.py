@@ -1 +1,2 @@
 from .decoder_only import DecoderTransformer  # noqa: F401
+from .rope import RoPE  # noqa: F401
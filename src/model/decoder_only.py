@@ -3,10 +3,39 @@ import equinox.nn as nn
 import jax
 import jax.numpy as jnp
 import jax.random as random
-from beartype import beartype
-from jaxtyping import Array, Bool, Float, Int, jaxtyped
+from jaxtyping import Array, Float, Int
 
-from .mha import MultiheadAttention, MultiheadSelectiveAttention
+from ..typecheck import typecheck
+from .ffn import FeedForward
+from .mha import MultiheadAttention, MultiheadSelectiveAttention, causal_mask
+from .rope import RoPE
+
+
+def cast_params(module: eqx.Module, dtype: jnp.dtype) -> eqx.Module:
+    """Cast the floating point parameters of the module to the given dtype.
+    The normalization layers and RoPE are kept in their original precision.
+    """
+    keep = lambda m: isinstance(m, (nn.LayerNorm, RoPE))  # noqa: E731
+    cast = lambda m: m.astype(dtype) if eqx.is_inexact_array(m) else m  # noqa: E731
+    return jax.tree.map(lambda m: m if keep(m) else cast(m), module, is_leaf=keep)
+
+
+@typecheck
+def residual_layernorm(
+    x: Float[Array, "batch_size seq_len d_model"],
+    y: Float[Array, "batch_size seq_len d_model"],
+    norm: nn.LayerNorm,
+) -> Float[Array, "batch_size seq_len d_model"]:
+    """Normalize the residual sum `x + y` with the parameters of `norm`.
+    The statistics are computed in float32 over the last axis, in a single
+    expression XLA can fuse, and the result is cast back to the input dtype.
+    """
+    z = (x + y).astype(jnp.float32)
+    mean = jnp.mean(z, axis=-1, keepdims=True)
+    var = jnp.mean(jnp.square(z - mean), axis=-1, keepdims=True)
+    z = (z - mean) * jax.lax.rsqrt(var + norm.eps)
+    z = z * norm.weight + norm.bias
+    return z.astype(x.dtype)
 
 
 class DecoderLayer(eqx.Module):
@@ -16,10 +45,17 @@ class DecoderLayer(eqx.Module):
         - "selective": Use the selective attention.
         - "standard": Use the standard attention, implemented here.
         - "equinox": Use the standard attention, implemented by equinox.
+
+    The layer is applied to a whole batch of sequences. Only the selective and
+    the equinox attentions are mapped over the batch, as they are written
+    for a single sequence.
+
+    With `fp8`, the feed-forward matmuls and the q, k and v projection of the
+    standard attention are computed in float8.
     """
 
     mha: MultiheadAttention | MultiheadSelectiveAttention | nn.MultiheadAttention
-    ffn: nn.Sequential
+    ffn: FeedForward
     norm_1: nn.LayerNorm
     norm_2: nn.LayerNorm
 
@@ -29,6 +65,7 @@ class DecoderLayer(eqx.Module):
         num_heads: int,
         mha_type: str,
         rope: bool,
+        fp8: bool,
         key: random.PRNGKey,
     ):
         super().__init__()
@@ -39,39 +76,34 @@ class DecoderLayer(eqx.Module):
             case "selective":
                 self.mha = MultiheadSelectiveAttention(num_heads, d_model, rope, key=sk)
             case "standard":
-                self.mha = MultiheadAttention(num_heads, d_model, rope, key=sk)
+                self.mha = MultiheadAttention(num_heads, d_model, rope, fp8, key=sk)
             case "equinox":
                 self.mha = nn.MultiheadAttention(num_heads, d_model, key=sk)
             case _:
                 raise ValueError(f"Unknown mha_type: {mha_type}")
 
-        sk_1, sk_2 = random.split(key, 2)
-        self.ffn = nn.Sequential(
-            [
-                nn.Linear(d_model, d_model * 4, use_bias=False, key=sk_1),
-                nn.Lambda(jax.nn.relu),
-                nn.Linear(4 * d_model, d_model, use_bias=False, key=sk_2),
-            ]
-        )
+        self.ffn = FeedForward(d_model, 4 * d_model, fp8, key)
 
         self.norm_1 = nn.LayerNorm(d_model)
         self.norm_2 = nn.LayerNorm(d_model)
 
-    @eqx.filter_jit
-    @jaxtyped(typechecker=beartype)
+    @typecheck
     def __call__(
-        self,
-        x: Float[Array, "seq_len d_model"],
-        mask: Bool[Array, "seq_len seq_len"],
-    ) -> Float[Array, "seq_len d_model"]:
-        """Apply the decoder layer to the input. The attention between token i and j
-        is computed where the mask[i, j] is true.
-        """
-        x_att = self.mha(x, x, x, mask)
-        x = jax.vmap(self.norm_1)(x + x_att)
-
-        x_ffn = jax.vmap(self.ffn)(x)
-        x = jax.vmap(self.norm_2)(x + x_ffn)
+        self, x: Float[Array, "batch_size seq_len d_model"]
+    ) -> Float[Array, "batch_size seq_len d_model"]:
+        """Apply the decoder layer to the input. The attention is causal."""
+        match self.mha:
+            case MultiheadAttention():
+                x_att = self.mha(x)  # Always causal.
+            case MultiheadSelectiveAttention():
+                x_att = jax.vmap(self.mha)(x)  # Always causal.
+            case nn.MultiheadAttention():
+                mask = causal_mask(x.shape[1])
+                x_att = jax.vmap(lambda x: self.mha(x, x, x, mask))(x)
+        x = residual_layernorm(x, x_att, self.norm_1)
+
+        x_ffn = self.ffn(x)
+        x = residual_layernorm(x, x_ffn, self.norm_2)
 
         return x
 
@@ -83,11 +115,20 @@ class DecoderTransformer(eqx.Module):
         - "selective": Use the selective attention.
         - "standard": Use the standard attention, implemented here.
         - "equinox": Use the standard attention, implemented by equinox.
+
+    The parameters are stored in float32 but the forward pass is computed in
+    `dtype` (mixed precision). The normalizations and the logits are computed
+    in float32. With `fp8`, the feed-forward and q, k and v projection matmuls are
+    computed in float8 (see `DecoderLayer`).
+
+    The decoder layers are stacked into a single `DecoderLayer` whose parameters
+    have a leading `num_layers` dimension, and are applied with `jax.lax.scan`.
     """
 
-    layers: nn.Sequential
+    layers: DecoderLayer
     embedding: nn.Embedding
     logits: nn.Linear
+    dtype: str
 
     def __init__(
         self,
@@ -98,32 +139,44 @@ class DecoderTransformer(eqx.Module):
         rope: bool,
         num_layers: int,
         num_logits: int,
+        dtype: str,
+        fp8: bool,
         key: random.PRNGKey,
     ):
         super().__init__()
+        self.dtype = dtype
 
         key, sk = random.split(key)
         self.embedding = nn.Embedding(num_embeddings, d_model, key=sk)
 
-        key, *subkeys = random.split(key, num_layers + 1)
-        self.layers = nn.Sequential(
-            [DecoderLayer(d_model, num_heads, mha_type, rope, sk) for sk in subkeys]
-        )
+        subkeys = random.split(key, num_layers + 1)
+        key, subkeys = subkeys[0], subkeys[1:]
+        self.layers = eqx.filter_vmap(
+            lambda k: DecoderLayer(d_model, num_heads, mha_type, rope, fp8, k)
+        )(subkeys)
 
         self.logits = nn.Linear(d_model, num_logits, key=key)
 
     @eqx.filter_jit
-    @jaxtyped(typechecker=beartype)
-    def __call__(self, x: Int[Array, " seq_len"]) -> Float[Array, "seq_len d_model"]:
-        """Apply the decoder to the input sequence. The mask used is a causal mask."""
-        mask = jnp.eye(x.shape[0], dtype=int)
-        mask = jnp.cumsum(mask, axis=1).T
-        mask = mask.astype(bool)
+    @typecheck
+    def __call__(
+        self, x: Int[Array, "batch_size seq_len"]
+    ) -> Float[Array, "batch_size seq_len num_logits"]:
+        """Apply the decoder to a batch of input sequences. The attention is causal."""
+        dtype = jnp.dtype(self.dtype)
+        x = self.embedding.weight[x].astype(dtype)
+
+        layers = cast_params(self.layers, dtype)
+        params, static = eqx.partition(layers, eqx.is_array)
 
-        x = jax.vmap(self.embedding)(x)
+        def apply_layer(x, params):
+            decoder_layer = eqx.combine(params, static)
+            return decoder_layer(x), None
 
-        for decoder_layer in self.layers:
-            x = decoder_layer(x, mask)
+        x, _ = jax.lax.scan(apply_layer, x, params)
 
-        x = jax.vmap(self.logits)(x)
+        # Accumulate the logits in float32.
+        weight = self.logits.weight.astype(dtype)
+        x = jnp.matmul(x, weight.T, preferred_element_type=jnp.float32)
+        x = x + self.logits.bias
         return x
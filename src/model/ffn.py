@@ -0,0 +1,45 @@
+import math
+
+import equinox as eqx
+import jax
+import jax.numpy as jnp
+import jax.random as random
+from jaxtyping import Array, Float
+
+from ..typecheck import typecheck
+from .fp8 import fp8_dense
+
+
+class FeedForward(eqx.Module):
+    """Two linear layers with a ReLU in between, without biases.
+
+    The weights are stored as raw matrices and applied with plain matmuls so
+    that XLA sees a simple `matmul -> relu -> matmul` chain it can fuse, instead
+    of a sequence of modules. Optionally compute the matmuls in float8.
+    """
+
+    w_1: Float[Array, "d_hidden d_model"]
+    w_2: Float[Array, "d_model d_hidden"]
+    fp8: bool
+
+    def __init__(self, d_model: int, d_hidden: int, fp8: bool, key: random.PRNGKey):
+        super().__init__()
+        self.fp8 = fp8
+        sk_1, sk_2 = random.split(key, 2)
+
+        # Same initialization as `nn.Linear`.
+        lim_1, lim_2 = 1 / math.sqrt(d_model), 1 / math.sqrt(d_hidden)
+        self.w_1 = random.uniform(
+            sk_1, (d_hidden, d_model), minval=-lim_1, maxval=lim_1
+        )
+        self.w_2 = random.uniform(
+            sk_2, (d_model, d_hidden), minval=-lim_2, maxval=lim_2
+        )
+
+    @typecheck
+    def __call__(
+        self, x: Float[Array, "batch_size seq_len d_model"]
+    ) -> Float[Array, "batch_size seq_len d_model"]:
+        matmul = fp8_dense if self.fp8 else jnp.matmul
+        h = jax.nn.relu(matmul(x, self.w_1.T))
+        return matmul(h, self.w_2.T)
@@ -0,0 +1,72 @@
+import jax
+import jax.numpy as jnp
+from jaxtyping import Array, Float
+
+from ..typecheck import typecheck
+
+E4M3_MAX = float(jnp.finfo(jnp.float8_e4m3fn).max)
+
+
+def quantize(
+    x: Float[Array, "..."],
+) -> tuple[Float[Array, "..."], Float[Array, ""]]:
+    """Quantize the tensor to float8 (E4M3) using a per-tensor scale.
+    The scale maps the largest absolute value of the tensor to the largest
+    representable float8 value.
+    """
+    scale = jnp.max(jnp.abs(x)).astype(jnp.float32) / E4M3_MAX
+    scale = jnp.maximum(scale, jnp.finfo(jnp.float32).tiny)  # Avoid dividing by 0.
+    x_q = jnp.clip(x.astype(jnp.float32) / scale, -E4M3_MAX, E4M3_MAX)
+    return x_q.astype(jnp.float8_e4m3fn), scale
+
+
+def dequantize(
+    x_q: Float[Array, "..."], scale: Float[Array, ""], dtype: jnp.dtype
+) -> Float[Array, "..."]:
+    return x_q.astype(dtype) * scale.astype(dtype)
+
+
+@jax.custom_vjp
+@typecheck
+def fp8_matmul(a: Float[Array, "n k"], b: Float[Array, "k m"]) -> Float[Array, "n m"]:
+    """Compute `a @ b` with both operands quantized to float8.
+
+    The `quantize -> dequantize -> dot` pattern is recognized by XLA on GPUs
+    supporting float8 (Hopper and later), which rewrites it as a single cuBLASLt
+    float8 matmul. The rewrite requires a scalar scale per operand, so this must
+    not be mapped over a batch (see `fp8_dense`). Elsewhere XLA may simplify the
+    float8 conversions away under `jit`, as it does on CPU, and compute a regular
+    matmul of the original operands.
+
+    The backward pass uses the original operands (straight-through estimator).
+    """
+    a_q, a_scale = quantize(a)
+    b_q, b_scale = quantize(b)
+    a_dq = dequantize(a_q, a_scale, a.dtype)
+    b_dq = dequantize(b_q, b_scale, b.dtype)
+    return jnp.matmul(a_dq, b_dq)
+
+
+def fp8_matmul_fwd(a: Array, b: Array) -> tuple[Array, tuple[Array, Array]]:
+    return fp8_matmul(a, b), (a, b)
+
+
+def fp8_matmul_bwd(residuals: tuple[Array, Array], grad: Array) -> tuple[Array, Array]:
+    a, b = residuals
+    grad_a = jnp.matmul(grad, b.T).astype(a.dtype)
+    grad_b = jnp.matmul(a.T, grad).astype(b.dtype)
+    return grad_a, grad_b
+
+
+fp8_matmul.defvjp(fp8_matmul_fwd, fp8_matmul_bwd)
+
+
+@typecheck
+def fp8_dense(
+    x: Float[Array, "*batch k"], w: Float[Array, "k m"]
+) -> Float[Array, "*batch m"]:
+    """Compute `x @ w` in float8. The leading dimensions of `x` are flattened
+    into a single matmul, so that the whole activation tensor has one scale.
+    """
+    y = fp8_matmul(x.reshape(-1, x.shape[-1]), w)
+    return y.reshape(*x.shape[:-1], w.shape[-1])
@@ -5,15 +5,15 @@ import equinox.nn as nn
 import jax
 import jax.numpy as jnp
 import jax.random as random
-from beartype import beartype
 from einops import rearrange
-from jaxtyping import Array, Bool, Float, jaxtyped
+from jaxtyping import Array, Bool, Float
 
+from ..typecheck import typecheck
+from .fp8 import fp8_dense
 from .rope import RoPE
 
 
-@jax.jit
-@jaxtyped(typechecker=beartype)
+@typecheck
 def qkv_attention(
     q: Float[Array, "q_seq d_model"],
     k: Float[Array, "kv_seq d_model"],
@@ -29,14 +29,16 @@ def qkv_attention(
     logits = jnp.einsum("ij,kj->ik", q, k)  # Dot-product attention.
     logits = logits / jnp.sqrt(k.shape[1])
 
+    # Compute the softmax in float32 in case of reduced precision inputs.
+    logits = logits.astype(jnp.float32)
     attn_distrib = jax.nn.softmax(logits, axis=1, where=mask, initial=-jnp.inf)
+    attn_distrib = attn_distrib.astype(v.dtype)
     attn_result = jnp.einsum("ij,jk->ik", attn_distrib, v)  # Apply attention to v.
 
     return attn_result
 
 
-@jax.jit
-@jaxtyped(typechecker=beartype)
+@typecheck
 def qkv_selective_attention(
     q: Float[Array, "q_seq d_model"],
     k: Float[Array, "q_seq kv_seq d_model"],
@@ -53,8 +55,7 @@ def qkv_selective_attention(
     return attn_result
 
 
-@jax.jit
-@jaxtyped(typechecker=beartype)
+@typecheck
 def cross_product_matching(
     query: Float[Array, "q_seq q_size"], other: Float[Array, "o_seq o_size"]
 ) -> Float[Array, "q_seq o_seq q_size+o_size"]:
@@ -65,69 +66,100 @@ def cross_product_matching(
     return cat(query, other)
 
 
+def causal_mask(seq_len: int) -> Bool[Array, "seq_len seq_len"]:
+    """Token i can attend to token j only if j <= i.
+    The sequence length is static, so XLA builds this mask at compile time.
+    """
+    return jnp.tril(jnp.ones((seq_len, seq_len), dtype=bool))
+
+
+def attention_implementation(dtype: jnp.dtype, head_dim: int) -> Optional[str]:
+    """Select the cuDNN fused attention when it supports the inputs, that is
+    on NVIDIA GPUs from Ampere onwards, with half precision inputs and a head
+    dimension that is a multiple of 8 up to 128. Fallback to XLA otherwise.
+    """
+    if jax.default_backend() != "gpu" or dtype not in (jnp.float16, jnp.bfloat16):
+        return None
+    if head_dim > 128 or head_dim % 8 != 0:
+        return None
+
+    device = jax.local_devices(backend="gpu")[0]
+    capability = getattr(device, "compute_capability", None)  # Only on CUDA.
+    if capability is None or tuple(map(int, capability.split("."))) < (8, 0):
+        return None
+    return "cudnn"
+
+
 class MultiheadAttention(eqx.Module):
-    """Project q, k and v before applying the standard attention.
+    """Project x into q, k and v before applying the standard causal self-attention.
     Optionally apply rotary positional encoding to q and k.
+
+    The input is a whole batch of sequences. The attention itself is computed by
+    `jax.nn.dot_product_attention`, which can dispatch to the fused cuDNN kernel.
+    Optionally compute the projection in float8.
     """
 
-    project_q: nn.Linear
-    project_k: nn.Linear
-    project_v: nn.Linear
+    project_qkv: nn.Linear
     rope: Optional[RoPE]
     num_heads: int
+    fp8: bool
 
-    def __init__(self, num_heads: int, d_model: int, rope: bool, key: random.PRNGKey):
+    def __init__(
+        self,
+        num_heads: int,
+        d_model: int,
+        rope: bool,
+        fp8: bool,
+        key: random.PRNGKey,
+    ):
         super().__init__()
         assert d_model % num_heads == 0
         self.num_heads = num_heads
+        self.fp8 = fp8
 
-        sk = random.split(key, 3)
-        self.project_q = nn.Linear(d_model, d_model, use_bias=False, key=sk[0])
-        self.project_k = nn.Linear(d_model, d_model, use_bias=False, key=sk[1])
-        self.project_v = nn.Linear(d_model, d_model, use_bias=False, key=sk[2])
+        # A single projection for q, k and v.
+        self.project_qkv = nn.Linear(d_model, 3 * d_model, use_bias=False, key=key)
 
         self.rope = RoPE(d_model // num_heads, max_seq_len=10000) if rope else None
 
-    @eqx.filter_jit
-    @jaxtyped(typechecker=beartype)
+    @typecheck
     def __call__(
-        self,
-        q: Float[Array, "seq_len d_model"],
-        k: Float[Array, "seq_len d_model"],
-        v: Float[Array, "seq_len d_model"],
-        mask: Bool[Array, "seq_len seq_len"],
-    ) -> Float[Array, "seq_len d_model"]:
+        self, x: Float[Array, "batch_size seq_len d_model"]
+    ) -> Float[Array, "batch_size seq_len d_model"]:
         # Project q k and v.
-        q = jax.vmap(self.project_q)(q)
-        k = jax.vmap(self.project_k)(k)
-        v = jax.vmap(self.project_v)(v)
+        matmul = fp8_dense if self.fp8 else jnp.matmul
+        qkv = matmul(x, self.project_qkv.weight.T)
+        q, k, v = jnp.split(qkv, 3, axis=2)
 
         # Separate heads.
-        q_heads = rearrange(q, "s (n d) -> n s d", n=self.num_heads)
-        k_heads = rearrange(k, "s (n d) -> n s d", n=self.num_heads)
-        v_heads = rearrange(v, "s (n d) -> n s d", n=self.num_heads)
+        q_heads = rearrange(q, "b s (n d) -> b s n d", n=self.num_heads)
+        k_heads = rearrange(k, "b s (n d) -> b s n d", n=self.num_heads)
+        v_heads = rearrange(v, "b s (n d) -> b s n d", n=self.num_heads)
 
         if self.rope is not None:
             # Apply RoPE.
-            rope = jax.vmap(self.rope)
+            rope = jax.vmap(self.rope, in_axes=2, out_axes=2)
             q_heads = rope(q_heads)
             k_heads = rope(k_heads)
 
-        # Do not vmap the mask. The mask is the same accross all heads.
-        multihead_qkv_attention = jax.vmap(qkv_attention, in_axes=(0, 0, 0, None))
-        attn_result = multihead_qkv_attention(q_heads, k_heads, v_heads, mask)
-        attn_result = rearrange(attn_result, "n s d -> s (n d)")
+        attn_result = jax.nn.dot_product_attention(
+            q_heads,
+            k_heads,
+            v_heads,
+            is_causal=True,
+            implementation=attention_implementation(q_heads.dtype, q_heads.shape[-1]),
+        )
+        attn_result = rearrange(attn_result, "b s n d -> b s (n d)")
         return attn_result
 
 
 class MultiheadSelectiveAttention(eqx.Module):
-    """Project q, k and v before applying the selective attention.
+    """Project x into q, k and v before applying the selective causal self-attention.
     Optionally apply rotary positional encoding to q and k.
     """
 
     project_q: nn.Linear
-    project_k: nn.Linear
-    project_v: nn.Linear
+    project_kv: nn.Linear
     rope: Optional[RoPE]
     num_heads: int
 
@@ -136,33 +168,27 @@ class MultiheadSelectiveAttention(eqx.Module):
         assert d_model % num_heads == 0
         self.num_heads = num_heads
 
-        sk = random.split(key, 3)
+        sk = random.split(key, 2)
         self.project_q = nn.Linear(d_model, d_model, use_bias=False, key=sk[0])
-        self.project_k = nn.Linear(2 * d_model, d_model, use_bias=False, key=sk[1])
-        self.project_v = nn.Linear(2 * d_model, d_model, use_bias=False, key=sk[2])
+        # A single projection for k and v, since they share the same input.
+        self.project_kv = nn.Linear(2 * d_model, 2 * d_model, use_bias=False, key=sk[1])
 
         self.rope = RoPE(d_model // num_heads, max_seq_len=10000) if rope else None
 
-    @eqx.filter_jit
-    @jaxtyped(typechecker=beartype)
+    @typecheck
     def __call__(
-        self,
-        q: Float[Array, "seq_len d_model"],
-        k: Float[Array, "seq_len d_model"],
-        v: Float[Array, "seq_len d_model"],
-        mask: Bool[Array, "seq_len seq_len"],
+        self, x: Float[Array, "seq_len d_model"]
     ) -> Float[Array, "seq_len d_model"]:
         # First compute the queries.
-        q = jax.vmap(self.project_q)(q)
+        q = jax.vmap(self.project_q)(x)
 
-        # Match every k and v to every q.
-        # Shape of [q_seq, kv_seq, d_model].
-        k = cross_product_matching(q, k)
-        v = cross_product_matching(q, v)
+        # Match every token to every q.
+        # Shape of [q_seq, kv_seq, 2 * d_model].
+        kv = cross_product_matching(q, x)
 
         # Project k and v.
-        k = jax.vmap(jax.vmap(self.project_k))(k)
-        v = jax.vmap(jax.vmap(self.project_v))(v)
+        kv = jax.vmap(jax.vmap(self.project_kv))(kv)
+        k, v = jnp.split(kv, 2, axis=2)
 
         # Separate heads.
         # Shape of [num_heads, q_seq, kv_seq, d_model // num_heads].
@@ -178,6 +204,7 @@ class MultiheadSelectiveAttention(eqx.Module):
             k_heads = rope(k_heads)
 
         # Finally compute cubic attention.
+        mask = causal_mask(x.shape[0])
         multihead_qkv_attention = jax.vmap(
             qkv_selective_attention, in_axes=(0, 0, 0, None)
         )
@@ -1,8 +1,9 @@
 import equinox as eqx
 import jax
 import jax.numpy as jnp
-from beartype import beartype
-from jaxtyping import Array, Float, jaxtyped
+from jaxtyping import Array, Float
+
+from ..typecheck import typecheck
 
 
 class RoPE(eqx.Module):
@@ -28,14 +29,15 @@ class RoPE(eqx.Module):
         self.cos = jnp.cos(pos_thetas)
         self.sin = jnp.sin(pos_thetas)
 
-    @eqx.filter_jit
-    @jaxtyped(typechecker=beartype)
+    @typecheck
     def __call__(
-        self, x: Float[Array, "seq_len d_model"]
-    ) -> Float[Array, "seq_len d_model"]:
-        """Apply the rotary positional encoding to the given tokens."""
-        seq_len = x.shape[0]
-        x1, x2 = jnp.split(x, 2, axis=1)
+        self, x: Float[Array, "*batch seq_len d_model"]
+    ) -> Float[Array, "*batch seq_len d_model"]:
+        """Apply the rotary positional encoding to the given tokens.
+        Any leading dimension is treated as a batch dimension.
+        """
+        seq_len = x.shape[-2]
+        x1, x2 = jnp.split(x, 2, axis=-1)
 
         # Those are not trainable.
         cos = jax.lax.stop_gradient(self.cos)
@@ -44,5 +46,5 @@ class RoPE(eqx.Module):
         x1_rot = x1 * cos[:seq_len] - x2 * sin[:seq_len]
         x2_rot = x1 * sin[:seq_len] + x2 * cos[:seq_len]
 
-        x = jnp.concat((x1_rot, x2_rot), axis=1)
-        return x
+        x_rot = jnp.concat((x1_rot, x2_rot), axis=-1)
+        return x_rot.astype(x.dtype)
@@ -0,0 +1,156 @@
+from typing import NamedTuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+from jaxtyping import Array, Float, Int
+
+
+def dynamic_code(signed: bool) -> np.ndarray:
+    """Build the 256 sorted values of the dynamic tree quantization in [-1, 1].
+
+    Each value is a power of ten times a linearly spaced fraction in [0.1, 1].
+    Smaller powers of ten get fewer fractions, so that the code is precise for
+    large values but can still represent values down to 1e-7. The signed code
+    spends one bit on the sign.
+    """
+    code = [0.0, 1.0]
+    for i in range(7):
+        num_fractions = 2**i if signed else 2 ** (i + 1)
+        bounds = np.linspace(0.1, 1, num_fractions + 1)
+        fractions = 10 ** (i - 6) * (bounds[:-1] + bounds[1:]) / 2
+        code.extend(fractions)
+        if signed:
+            code.extend(-fractions)
+    assert len(code) == 256
+    return np.sort(np.array(code, dtype=np.float32))
+
+
+SIGNED_CODE = dynamic_code(signed=True)
+UNSIGNED_CODE = dynamic_code(signed=False)
+
+
+class QuantizedArray(NamedTuple):
+    """An array quantized to 8 bits by blocks of contiguous elements.
+    Each block has its own float32 scale, and the values are indices in the
+    signed or unsigned dynamic code.
+    """
+
+    values: Int[Array, "num_blocks block_size"]
+    scales: Float[Array, "num_blocks 1"]
+
+
+def quantize(x: Float[Array, "..."], signed: bool, block_size: int) -> QuantizedArray:
+    """Quantize the array using the absolute max of each block as its scale.
+    The values are rounded to the nearest value of the code. For non-negative
+    arrays, positive values are never rounded to 0 so that they do not vanish.
+    """
+    x = x.reshape(-1)
+    x = jnp.pad(x, (0, -x.size % block_size))
+    x = x.reshape(-1, block_size)
+
+    scales = jnp.max(jnp.abs(x), axis=1, keepdims=True)
+    scales = jnp.maximum(scales, jnp.finfo(jnp.float32).tiny)  # Avoid dividing by 0.
+    x = x / scales
+
+    code = jnp.asarray(SIGNED_CODE if signed else UNSIGNED_CODE)
+    values = jnp.clip(jnp.searchsorted(code, x), 1, len(code) - 1)  # code[v] >= x.
+    closer_below = x - code[values - 1] < code[values] - x
+    values = jnp.where(closer_below, values - 1, values)
+    if not signed:
+        values = jnp.where(x > 0, jnp.maximum(values, 1), values)  # code[1] > 0.
+    return QuantizedArray(values.astype(jnp.uint8), scales)
+
+
+def dequantize(q: QuantizedArray, like: Array, signed: bool) -> Float[Array, "..."]:
+    """Recover the float32 array with the same shape as `like`."""
+    code = jnp.asarray(SIGNED_CODE if signed else UNSIGNED_CODE)
+    x = code[q.values] * q.scales
+    x = x.reshape(-1)[: like.size]
+    return x.reshape(like.shape)
+
+
+class ScaleByAdam8bitState(NamedTuple):
+    count: Int[Array, ""]
+    mu: optax.Updates
+    nu: optax.Updates
+
+
+def scale_by_adam_8bit(
+    b1: float = 0.9,
+    b2: float = 0.999,
+    eps: float = 1e-8,
+    block_size: int = 64,
+    min_8bit_size: int = 4096,
+) -> optax.GradientTransformation:
+    """Rescale the updates like Adam, but keep the moments quantized to 8 bits.
+
+    Both moments use the dynamic (non-linear) quantization of the paper, so that
+    the small entries of a block are not rounded to 0. The second moment is
+    quantized through its square root to further reduce its dynamic range.
+    Arrays smaller than `min_8bit_size` are kept in float32, as they are not
+    worth quantizing.
+
+    Paper: 8-bit Optimizers via Block-wise Quantization - https://arxiv.org/abs/2110.02861
+    """
+
+    def compress(x: Array, signed: bool) -> Array | QuantizedArray:
+        if x.size < min_8bit_size:
+            return x
+        return quantize(x, signed, block_size)
+
+    def decompress(x: Array | QuantizedArray, like: Array, signed: bool) -> Array:
+        if isinstance(x, QuantizedArray):
+            return dequantize(x, like, signed)
+        return x
+
+    def init_fn(params: optax.Params) -> ScaleByAdam8bitState:
+        zeros = lambda p: jnp.zeros_like(p, dtype=jnp.float32)  # noqa: E731
+        mu = jax.tree.map(lambda p: compress(zeros(p), signed=True), params)
+        nu = jax.tree.map(lambda p: compress(zeros(p), signed=False), params)
+        return ScaleByAdam8bitState(jnp.zeros([], dtype=jnp.int32), mu, nu)
+
+    def update_fn(
+        updates: optax.Updates,
+        state: ScaleByAdam8bitState,
+        params: optax.Params | None = None,
+    ) -> tuple[optax.Updates, ScaleByAdam8bitState]:
+        del params
+        mu = jax.tree.map(lambda g, m: decompress(m, g, signed=True), updates, state.mu)
+        nu = jax.tree.map(
+            lambda g, v: jnp.square(decompress(v, g, signed=False)), updates, state.nu
+        )
+
+        mu = jax.tree.map(lambda g, m: b1 * m + (1 - b1) * g, updates, mu)
+        nu = jax.tree.map(lambda g, v: b2 * v + (1 - b2) * jnp.square(g), updates, nu)
+
+        count = optax.safe_int32_increment(state.count)
+        mu_hat_scale = 1 / (1 - b1 ** count.astype(jnp.float32))
+        nu_hat_scale = 1 / (1 - b2 ** count.astype(jnp.float32))
+        updates = jax.tree.map(
+            lambda m, v: (m * mu_hat_scale) / (jnp.sqrt(v * nu_hat_scale) + eps),
+            mu,
+            nu,
+        )
+
+        mu = jax.tree.map(lambda m: compress(m, signed=True), mu)
+        nu = jax.tree.map(lambda v: compress(jnp.sqrt(v), signed=False), nu)
+        return updates, ScaleByAdam8bitState(count, mu, nu)
+
+    return optax.GradientTransformation(init_fn, update_fn)
+
+
+def adamw_8bit(
+    learning_rate: float,
+    b1: float = 0.9,
+    b2: float = 0.999,
+    eps: float = 1e-8,
+    weight_decay: float = 1e-4,
+) -> optax.GradientTransformation:
+    """AdamW with 8-bit moments, using the same defaults as `optax.adamw`."""
+    return optax.chain(
+        scale_by_adam_8bit(b1, b2, eps),
+        optax.add_decayed_weights(weight_decay),
+        optax.scale_by_learning_rate(learning_rate),
+    )
@@ -1,50 +1,92 @@
-from collections import defaultdict
+from collections import deque
 from functools import partial
-from typing import Iterable
+from typing import Callable, Iterator
 
 import equinox as eqx
 import jax
 import jax.numpy as jnp
 import jax.random as random
+import numpy as np
 import optax
-from beartype import beartype
-from jaxtyping import Array, Float, Int, jaxtyped
+from jaxtyping import Array, Float, Int
 from optax.losses import softmax_cross_entropy_with_integer_labels
 from tqdm import tqdm
 from wandb.wandb_run import Run
 
 from .datasets import ShakespearDataset
-from .model import DecoderTransformer
+from .model import DecoderTransformer, RoPE
+from .optim import adamw_8bit
+from .typecheck import typecheck
 
 
-def loader(dataset: Iterable, batch_size: int, n_iters: int, key: random.PRNGKey):
-    """Yield batches of samples from the dataset."""
-    for sk in random.split(key, n_iters):
-        batch_ids = random.choice(sk, len(dataset), (batch_size,), replace=True)
-        batch_samples = [dataset[id_] for id_ in batch_ids]
-        batch_samples = jnp.stack(batch_samples)
+def loader(
+    dataset: ShakespearDataset, batch_size: int, n_iters: int, key: random.PRNGKey
+):
+    """Yield batches of samples from the dataset.
+    The samples are drawn and gathered on the host, with a NumPy generator
+    seeded from the given key.
+    """
+    rng = np.random.default_rng(np.asarray(random.key_data(key)))
+    for _ in range(n_iters):
+        batch_ids = rng.integers(0, len(dataset), size=batch_size)
+        batch_samples = dataset[batch_ids]
         yield batch_samples
 
 
-def count_params(model: eqx.Module) -> Int[Array, ""]:
+def prefetch(batches: Iterator[np.ndarray], size: int = 2) -> Iterator[Array]:
+    """Send the next batches to the device ahead of time.
+    Transfers are asynchronous, so they overlap with the computation of the
+    current step as long as the result of that step is not awaited.
+    """
+    queue = deque()
+    for batch in batches:
+        queue.append(jax.device_put(batch))
+        if len(queue) == size:
+            yield queue.popleft()
+
+    while queue:
+        yield queue.popleft()
+
+
+# Compiled steps, indexed by the shapes and static values of their arguments.
+_compiled_steps = dict()
+
+
+def compile_step(step: Callable, *args) -> Callable:
+    """Compile the jitted step ahead of time for the given arguments.
+    Arrays can be given as `jax.ShapeDtypeStruct`, only their shapes and dtypes are
+    used. Compilations are cached so that calling this multiple times with the same
+    shapes is free. Note that the compiled step is called without its static args.
+    """
+    array_types = (jax.Array, np.ndarray, jax.ShapeDtypeStruct)
+    leaves, treedef = jax.tree.flatten(args)
+    leaves = tuple(
+        (x.shape, x.dtype) if isinstance(x, array_types) else x for x in leaves
+    )
+
+    key = (step, treedef, leaves)
+    if key not in _compiled_steps:
+        _compiled_steps[key] = step.lower(*args).compile()
+    return _compiled_steps[key]
+
+
+def count_params(model: eqx.Module) -> int:
     """Count the number of parameters of the given equinox module.
     Ignore the RoPE parameters as they are not learnable.
     """
-    # Replace the params of the RoPE module by None to filter them out.
-    model = jax.tree_util.tree_map_with_path(
-        lambda p, v: None if "rope" in jax.tree_util.keystr(p) else v, model
+    # Treat the RoPE modules as leaves so that they can be filtered out directly.
+    is_rope = lambda m: isinstance(m, RoPE)  # noqa: E731
+    params = eqx.filter(
+        model, lambda m: not is_rope(m) and eqx.is_array(m), is_leaf=is_rope
     )
-    params = eqx.filter(model, eqx.is_array)
-    # jax.tree_util.tree_map_with_path(lambda p, _: print(p), params)
 
-    n_params = jax.tree.map(lambda p: jnp.prod(jnp.array(p.shape)), params)
-    n_params = jnp.array(jax.tree.leaves(n_params))
-    n_params = jnp.sum(n_params)
+    # Only the shapes are needed, this does not touch the device.
+    n_params = sum(p.size for p in jax.tree.leaves(params))
     return n_params
 
 
-@jaxtyped(typechecker=beartype)
 @partial(jax.jit, static_argnums=1)
+@typecheck
 def loss_fn(
     params: eqx.Module,
     static: eqx.Module,
@@ -53,13 +95,13 @@ def loss_fn(
     """Compute the loss for the given batch of tokens."""
     model = eqx.combine(params, static)
     x, y = tokens[:, :-1], tokens[:, 1:]
-    y_logits = jax.vmap(model)(x)
+    y_logits = model(x)
     loss = softmax_cross_entropy_with_integer_labels(y_logits, y)
     return jnp.mean(loss)
 
 
-@jaxtyped(typechecker=beartype)
 @partial(jax.jit, static_argnums=1)
+@typecheck
 def batch_metrics(
     params: eqx.Module,
     static: eqx.Module,
@@ -69,7 +111,7 @@ def batch_metrics(
     metrics = dict()
     model = eqx.combine(params, static)
     x, y = tokens[:, :-1], tokens[:, 1:]
-    y_logits = jax.vmap(model)(x)
+    y_logits = model(x)
 
     metrics["cross-entropy"] = softmax_cross_entropy_with_integer_labels(y_logits, y)
     metrics["accuracy"] = y_logits.argmax(axis=2) == y
@@ -78,6 +120,40 @@ def batch_metrics(
     return metrics
 
 
+@partial(jax.jit, static_argnums=1)
+@typecheck
+def accumulate_metrics(
+    params: eqx.Module,
+    static: eqx.Module,
+    tokens: Int[Array, "batch_size seq_len"],
+    metrics: dict[str, Float[Array, ""]],
+) -> dict[str, Float[Array, ""]]:
+    """Add the metrics of the given batch of tokens to the running sums."""
+    metrics_ = batch_metrics(params, static, tokens)
+    return jax.tree.map(jnp.add, metrics, metrics_)
+
+
+@partial(jax.jit, static_argnums=(1, 2), donate_argnums=(0, 3))
+@typecheck
+def train_step(
+    params: eqx.Module,
+    static: eqx.Module,
+    optimizer: optax.GradientTransformation,
+    opt_state: optax.OptState,
+    tokens: Int[Array, "batch_size seq_len"],
+) -> tuple[eqx.Module, optax.OptState, Float[Array, ""]]:
+    """Do an optimization step on the given batch of tokens.
+    Return the updated parameters and optimizer state, along with the loss.
+
+    The buffers of the given parameters and optimizer state are donated so that
+    they can be updated in-place. They must not be used after this call.
+    """
+    loss, grads = jax.value_and_grad(loss_fn)(params, static, tokens)
+    updates, opt_state = optimizer.update(grads, opt_state, params)
+    params = optax.apply_updates(params, updates)
+    return params, opt_state, loss
+
+
 def eval(
     model: DecoderTransformer,
     dataset: ShakespearDataset,
@@ -86,23 +162,24 @@ def eval(
     key: random.PRNGKey,
 ) -> dict[str, Float[Array, ""]]:
     """Evaluate the model and averages the metrics over the number of iterations."""
-    metrics = defaultdict(list)
     params, static = eqx.partition(model, eqx.is_array)
+    # The running sums stay on the device until the end of the evaluation.
+    metrics = {"cross-entropy": jnp.zeros(()), "accuracy": jnp.zeros(())}
 
     dataloader = tqdm(
-        loader(dataset, batch_size, n_iters, key),
+        prefetch(loader(dataset, batch_size, n_iters, key)),
         desc="Evaluating",
         total=n_iters,
         leave=False,
     )
 
+    tokens = jax.ShapeDtypeStruct((batch_size, dataset.seq_len), jnp.int32)
+    accumulate = compile_step(accumulate_metrics, params, static, tokens, metrics)
+
     for batch in dataloader:
-        metrics_ = batch_metrics(params, static, batch)
-        for name, value in metrics_.items():
-            metrics[name].append(value)
+        metrics = accumulate(params, batch, metrics)
 
-    metrics = {name: jnp.array(values) for name, values in metrics.items()}
-    metrics = jax.tree.map(jnp.mean, metrics)
+    metrics = jax.tree.map(lambda m: m / n_iters, metrics)
     return metrics
 
 
@@ -111,6 +188,7 @@ def train(
     train_dataset: ShakespearDataset,
     test_dataset: ShakespearDataset,
     learning_rate: float,
+    optimizer_8bit: bool,
     batch_size: int,
     n_training_iter: int,
     n_eval_iter: int,
@@ -118,6 +196,7 @@ def train(
     key: random.PRNGKey,
 ):
     """Main training loop for the model.
+    The parameters of the given model are updated in-place, do not reuse it after.
 
     ---
     Args:
@@ -125,15 +204,18 @@ def train(
         train_dataset: The dataset to train on.
         test_dataset: The dataset to evaluate on.
         learning_rate: The learning rate of the optimizer.
+        optimizer_8bit: Whether to keep the AdamW moments quantized to 8 bits.
         batch_size: The size of the batches.
         n_training_iter: The number of training iterations.
         n_eval_iter: The number of evaluation iterations used to estimate the metrics.
         logger: The wandb logger.
         key: The random key to use.
     """
-    grad_fn = jax.grad(loss_fn)
     params, static = eqx.partition(model, eqx.is_array)
-    optimizer = optax.adamw(learning_rate)
+    if optimizer_8bit:
+        optimizer = adamw_8bit(learning_rate)
+    else:
+        optimizer = optax.adamw(learning_rate)
     opt_state = optimizer.init(params)
 
     n_params = count_params(model)
@@ -141,25 +223,31 @@ def train(
 
     key, sk = random.split(key)
     dataloader = tqdm(
-        loader(train_dataset, batch_size, n_training_iter, sk),
+        prefetch(loader(train_dataset, batch_size, n_training_iter, sk)),
         desc="Training",
         total=n_training_iter,
     )
 
+    # Compile before the first iteration, every batch has the same shape.
+    tokens = jax.ShapeDtypeStruct((batch_size, train_dataset.seq_len), jnp.int32)
+    step = compile_step(train_step, params, static, optimizer, opt_state, tokens)
+
+    train_losses = []
     for iter_id, batch in enumerate(dataloader):
-        grads = grad_fn(params, static, batch)
-        updates, opt_state = optimizer.update(grads, opt_state, params)
-        params = optax.apply_updates(params, updates)
+        params, opt_state, loss = step(params, opt_state, batch)
+        train_losses.append(loss)
 
         if iter_id % 100 == 0:
-            all_metrics = dict()
-            model = eqx.combine(params, static)
+            # The training loss is averaged over the steps since the last log.
+            train_loss = jnp.mean(jnp.stack(train_losses))
+            all_metrics = {"train/cross-entropy": float(train_loss)}
+            train_losses = []
 
-            for dataset, prefix in [(train_dataset, "train"), (test_dataset, "test")]:
-                key, sk = random.split(key)
-                metrics = eval(model, test_dataset, batch_size, n_eval_iter, key)
-                metrics = jax.tree.map(float, metrics)
-                metrics = {f"{prefix}/{name}": value for name, value in metrics.items()}
-                all_metrics.update(metrics)
+            key, sk = random.split(key)
+            model = eqx.combine(params, static)
+            metrics = eval(model, test_dataset, batch_size, n_eval_iter, sk)
+            metrics = jax.tree.map(float, metrics)
+            metrics = {f"test/{name}": value for name, value in metrics.items()}
+            all_metrics.update(metrics)
 
             logger.log(all_metrics)
@@ -0,0 +1,11 @@
+import os
+
+from beartype import beartype
+from jaxtyping import jaxtyped
+
+if os.environ.get("DEBUG_SHAPES"):
+    # Check the shapes and dtypes of the arguments and of the returned values.
+    typecheck = jaxtyped(typechecker=beartype)
+else:
+    # No runtime checks, the annotations are only informative.
+    typecheck = lambda fn: fn  # noqa: E731